@@ -1,9 +1,29 @@
+import os
+from functools import lru_cache
+
+import numpy as np
 import pandas as pd
 
 """
 Everything that has to do with the phantom calibration.
 """
 
+def _open_excel(fname):
+    """Open an Excel file, preferring the calamine engine if it is installed
+
+    Args:
+        fname (str): Full path to the Excel file
+
+    Returns:
+        pd.ExcelFile: Opened Excel file
+    """
+    try:
+        return pd.ExcelFile(fname, engine='calamine')
+    except (ImportError, ValueError):
+        # python-calamine not installed, or pandas too old to know the engine.
+        # Let pandas pick the engine from the file type (e.g. xlrd for .xls)
+        return pd.ExcelFile(fname)
+
 def read_calibration_sheet(fname, sheets=None):
     """Parse CaliberMRI calibration sheet
 
@@ -25,19 +45,59 @@ def read_calibration_sheet(fname, sheets=None):
                 'CMRI LC Values':{'name':'CMRI_LC', 'head':3, 'tail':0}}
     
     data = {}
-    for sheet_key in sheets.keys():
-        df = pd.read_excel(fname, sheet_name=sheet_key, header=sheets[sheet_key]['head'])
-        data[sheets[sheet_key]['name']] = df[:-1*sheets[sheet_key]['tail']]
+    # Open the workbook once and parse each sheet from it
+    with _open_excel(fname) as xl:
+        for sheet_key in sheets.keys():
+            df = xl.parse(sheet_name=sheet_key, header=sheets[sheet_key]['head'])
+            data[sheets[sheet_key]['name']] = df[:len(df)-sheets[sheet_key]['tail']]
 
     return data
 
 
+@lru_cache(maxsize=4)
+def _load_calibration(fname, mtime):
+    """Cached version of read_calibration_sheet with the default sheets
+
+    Args:
+        fname (str): Full path to calibration .xls sheet
+        mtime (float): Modification time of the file, used to invalidate the cache
+
+    Returns:
+        dict: Dictionary of dataframes with calibration data
+    """
+    return read_calibration_sheet(fname)
+
+
 class Calibration():
 
     def __init__(self, fname):
-        self.data = read_calibration_sheet(fname)
+        if isinstance(fname, (str, os.PathLike)) and os.path.isfile(fname):
+            fname = os.path.abspath(fname)
+            self.data = _load_calibration(fname, os.path.getmtime(fname))
+        else:
+            # File-like objects, bytes, URLs etc. are passed straight to pandas
+            self.data = read_calibration_sheet(fname)
         self.__sheets = {3:{'T1': 'NiCl_3T', 'T2': 'MnCl_3T', 'ADC': 'ADC_3T', 'CuSO4': 'CuSO4_3T'},
                          1.5:{'T1': 'NiCl_15T', 'T2': 'MnCl_15T', 'ADC': 'ADC_15T'}}
+        self._vals = self._build_vals()
+
+    def _build_vals(self):
+        """Index the (ms) columns of each sheet by field strength, mimic, column and temperature
+
+        Returns:
+            dict: Dictionary (B0, mimics, column, temperature) -> values
+        """
+        vals = {}
+        for B0, mimic_sheets in self.__sheets.items():
+            for mimics, sheet in mimic_sheets.items():
+                df = self.data.get(sheet)
+                if df is None or 'Temperature (C)' not in df:
+                    continue
+                cols = [c for c in df.columns if isinstance(c, str) and c.endswith(' (ms)')]
+                for temp, grp in df.groupby('Temperature (C)', sort=False):
+                    for col in cols:
+                        vals[(B0, mimics, col[:-len(' (ms)')], temp)] = grp[col].to_numpy()
+        return vals
 
     def _get_vals(self, temp, mimics, column, B0=3):
         """Get T1 or T2 values for a given temperature, sorted from lowest to highest concentration
@@ -50,16 +110,21 @@ class Calibration():
         Returns:
             list: List of T1 or T2 values for a given temperature, sorted from lowest to highest concentration
         """
+        vals = self._vals.get((B0, mimics, column, temp))
+        if vals is not None:
+            return vals
+
         try:
             sheet = self.__sheets[B0][mimics]
         except KeyError:
             raise KeyError(f'Cannot find sheet for {mimics} at {B0}T. Available sheets are {self.__sheets.keys()}')
         else:
-            df = self.data.get(sheet)
+            if column + ' (ms)' not in self.data.get(sheet):
+                raise KeyError(column + ' (ms)')
             # if temp not in range(16, 27, 2):
                 # raise ValueError('Temperature not available. Available temperatures are 16, 18, 20, 22, 24 and 26 degrees Celsius')
             # else:
-            return df.loc[df['Temperature (C)'] == temp, column + ' (ms)'].values
+            return np.array([])
 
     
     def get_T1_conc(self):
@@ -1,9 +1,21 @@
 import ants
 import numpy as np
 import pandas as pd
+from scipy.linalg import eig
 from scipy.special import i0e
 from skimage.metrics import structural_similarity
 
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+try:
+    from numba import njit, prange
+    import numba_scipy.special  # noqa: F401, registers scipy.special overloads with numba
+except ImportError:
+    njit = None
+
 
 def logi0e(x):
     """
@@ -31,9 +43,53 @@ def rician_loglike(x, sigma, mu):
     float: The log-likelihood of the Rician distribution.
 
     """
-    return np.log(x) - 2*np.log(sigma) - (x**2 + mu**2)/(2*sigma**2) + logi0e(x*mu/sigma**2)
+    x = np.asarray(x, dtype=float)
+    sigma = np.asarray(sigma, dtype=float)
+    mu = np.asarray(mu, dtype=float)
+
+    if _rician_loglike_nb is not None:
+        x, sigma, mu = np.broadcast_arrays(x, sigma, mu)
+        return _rician_loglike_nb(x.ravel(), sigma.ravel(), mu.ravel()).reshape(x.shape)
+
+    s2 = sigma*sigma
+    li = logi0e(x*mu/s2)
+
+    if ne is not None:
+        return ne.evaluate('log(x) - 2*log(sigma) - (x*x + mu*mu)/(2*s2) + li')
+
+    return np.log(x) - 2*np.log(sigma) - (x*x + mu*mu)/(2*s2) + li
+
+if njit is not None:
+    # Keep nan/inf semantics (no nnan/ninf flags), zero sigmas must still give nan/inf
+    @njit(parallel=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'}, cache=True)
+    def _rician_loglike_nb(x, sigma, mu):
+        out = np.empty(x.size)
+        for i in prange(x.size):
+            s2 = sigma[i]*sigma[i]
+            z = x[i]*mu[i]/s2
+            li = np.log(i0e(z)) + z
+            out[i] = np.log(x[i]) - 2*np.log(sigma[i]) - (x[i]*x[i] + mu[i]*mu[i])/(2*s2) + li
+        return out
+else:
+    _rician_loglike_nb = None
+
+def _as_mask(inside, dtype):
+    """
+    Converts a boolean array to a mask of the given dtype, without copying for single byte types.
+
+    Parameters:
+    inside (numpy.ndarray): Boolean array.
+    dtype (numpy.dtype): Output dtype.
+
+    Returns:
+    numpy.ndarray: The mask with 1 inside and 0 outside.
+    """
 
-def make_sphere(img_shape, radius, center):
+    if np.dtype(dtype).itemsize == 1:
+        return inside.view(dtype)
+    return inside.astype(dtype)
+
+def make_sphere(img_shape, radius, center, dtype=np.uint8):
     """
     Create a binary sphere mask with the given radius and center.
 
@@ -41,6 +97,7 @@ def make_sphere(img_shape, radius, center):
     img_shape (tuple): The shape of the output mask in the form (nx, ny, nz).
     radius (float): The radius of the sphere.
     center (tuple): The center coordinates of the sphere in the form (cx, cy, cz).
+    dtype (numpy.dtype): Data type of the mask. Default: np.uint8, which ants.from_numpy accepts (bool is not).
 
     Returns:
     numpy.ndarray: A binary mask representing the sphere.
@@ -52,15 +109,21 @@ def make_sphere(img_shape, radius, center):
     cy = ny - center[1] - ny//2
     cz = nz - center[2] - nz//2
     
-    X, Y, Z = np.meshgrid(np.arange(-ny//2, ny//2) + cy, np.arange(-nx//2, nx//2) + cx, np.arange(-nz//2, nz//2) + cz)
-    D = np.sqrt(X**2 + Y**2 + Z**2)
-    
-    sphere = np.zeros(img_shape)
-    sphere[D < radius] = 1
+    # Open grids broadcast against each other, avoiding full 3D coordinate arrays
+    X, Y, Z = np.ogrid[-nx//2:nx//2, -ny//2:ny//2, -nz//2:nz//2]
+    X = X + cx
+    Y = Y + cy
+    Z = Z + cz
+    r2 = radius**2
+
+    if ne is not None:
+        inside = ne.evaluate('X*X + Y*Y + Z*Z < r2')
+    else:
+        inside = X*X + Y*Y + Z*Z < r2
 
-    return sphere
+    return _as_mask(inside, dtype)
 
-def make_circle(img_shape, radius, center):
+def make_circle(img_shape, radius, center, dtype=np.uint8):
     """
     Creates a binary circle image with the specified radius and center.
 
@@ -68,17 +131,17 @@ def make_circle(img_shape, radius, center):
     img_shape (tuple): The shape of the output image (height, width).
     radius (float): The radius of the circle.
     center (tuple): The center coordinates of the circle (x, y).
+    dtype (numpy.dtype): Data type of the image. Default: np.uint8
 
     Returns:
     numpy.ndarray: The binary circle image.
     """
 
     nx, ny = img_shape
-    X, Y = np.meshgrid(np.arange(-nx//2, nx//2) + center[0], np.arange(-ny//2, ny//2) + center[1])
-    D = np.sqrt(X**2 + Y**2)
-    circle = np.zeros(img_shape)
-    circle[D < radius] = 1
-    return circle
+    Y, X = np.ogrid[-nx//2:nx//2, -ny//2:ny//2]
+    X = X + center[0]
+    Y = Y + center[1]
+    return _as_mask(X*X + Y*Y < radius*radius, dtype)
 
 def get_center(img):
     """
@@ -97,6 +160,78 @@ def get_center(img):
 
     return np.array(img.origin) + dir*nmid*spacing
      
+def _design(x, y):
+    """
+    Builds the design matrix [x^2, xy, y^2, x, y, 1] for conic fitting.
+
+    Parameters:
+        x (array-like): The x-coordinates of the points.
+        y (array-like): The y-coordinates of the points.
+
+    Returns:
+        ndarray: Contiguous (n, 6) float64 design matrix.
+    """
+
+    x = np.asarray(x, dtype=float).ravel()
+    y = np.asarray(y, dtype=float).ravel()
+
+    D = np.empty((x.size, 6))
+    np.multiply(x, x, out=D[:, 0])
+    np.multiply(x, y, out=D[:, 1])
+    np.multiply(y, y, out=D[:, 2])
+    D[:, 3] = x
+    D[:, 4] = y
+    D[:, 5] = 1.0
+
+    return D
+
+def _scatter(x, y, chunk=65536):
+    """
+    Builds the scatter matrix D.T @ D of the conic design matrix from the moments of the points.
+
+    Every entry of the 6x6 matrix is a moment sum(x^i * y^j) with i + j <= 4. The 15 unique moments
+    are accumulated over fixed-size chunks of points, so memory use does not grow with the number of
+    points and the (n, 6) design matrix is never formed.
+
+    Parameters:
+        x (array-like): The x-coordinates of the points.
+        y (array-like): The y-coordinates of the points.
+        chunk (int): Number of points processed at a time. Default: 65536
+
+    Returns:
+        ndarray: The (6, 6) scatter matrix.
+    """
+
+    x = np.asarray(x, dtype=float).ravel()
+    y = np.asarray(y, dtype=float).ravel()
+
+    m = np.zeros((5, 5))
+    m[0, 0] = x.size
+    for start in range(0, x.size, chunk):
+        xc = x[start:start+chunk]
+        yc = y[start:start+chunk]
+
+        # Powers y^1 .. y^4, index 0 unused since x^i * y^0 is summed directly
+        y2 = yc*yc
+        yp = [None, yc, y2, y2*yc, y2*y2]
+        for j in range(1, 5):
+            m[0, j] += yp[j].sum()
+
+        # Each power of x is built from the previous one
+        xi = xc
+        for i in range(1, 5):
+            m[i, 0] += xi.sum()
+            for j in range(1, 5 - i):
+                m[i, j] += xi @ yp[j]
+            if i < 4:
+                xi = xi*xc
+
+    # Exponents of x and y for the columns [x^2, xy, y^2, x, y, 1]
+    px = np.array([2, 1, 0, 1, 0, 0])
+    py = np.array([0, 1, 2, 0, 1, 0])
+
+    return m[px[:, None] + px, py[:, None] + py]
+
 def fit_ellipse_eig(x, y):
     """
     Fits an ellipse to a set of 2D points using the eigenvector approach.
@@ -106,33 +241,57 @@ def fit_ellipse_eig(x, y):
         y (array-like): The y-coordinates of the points.
     
     Returns:
-        array-like: The coefficients of the fitted ellipse.
+        array-like: The coefficients of the fitted ellipse, normalised to unit length with A > 0.
+    
+    Raises:
+        ValueError: If no eigenvector satisfies the ellipse constraint 4AC - B^2 > 0.
     
     Note:
         Code generated by ChatGPT-4o
     """
 
-    x = np.array(x)
-    y = np.array(y)
-    x = x[:, np.newaxis]
-    y = y[:, np.newaxis]
-    
-    # Building the design matrix
-    D = np.hstack((x * x, x * y, y * y, x, y, np.ones_like(x)))
-    
+    x = np.asarray(x, dtype=float).ravel()
+    y = np.asarray(y, dtype=float).ravel()
+
+    # Translate and scale the points to zero mean and unit spread, otherwise S is too
+    # badly conditioned for points far from the origin
+    mx = x.mean()
+    my = y.mean()
+    sc = np.sqrt(0.5*(x.var() + y.var()))
+    if sc == 0:
+        sc = 1.0
+
     # Scatter matrix
-    S = np.dot(D.T, D)
+    S = _scatter((x - mx)/sc, (y - my)/sc)
     
     # Constraint matrix
     C = np.zeros([6, 6])
     C[0, 2] = C[2, 0] = 2
     C[1, 1] = -1
     
-    # Solving the generalized eigenvalue problem
-    E, V = np.linalg.eig(np.dot(np.linalg.inv(S), C))
-    n = np.argmax(np.abs(E))
-    
-    return V[:, n]
+    # Solving the generalized eigenvalue problem S a = E C a with QZ, which needs neither
+    # inv(S) nor a Cholesky factorisation of S (singular for points exactly on an ellipse).
+    # The ellipse solution is the finite eigenvalue whose eigenvector satisfies 4AC - B^2 > 0.
+    E, V = eig(S, C)
+    V = np.real(V)
+    V = V / np.linalg.norm(V, axis=0)
+    cond = 4 * V[0] * V[2] - V[1]**2
+    cond[~np.isfinite(E)] = -np.inf
+    n = np.argmax(cond)
+    if cond[n] <= 0:
+        raise ValueError('No ellipse solution found, points are degenerate')
+    A, B, C, D, E, F = V[:, n]
+
+    # Map the coefficients back to the original coordinates
+    fit = np.array([A/sc**2,
+                    B/sc**2,
+                    C/sc**2,
+                    D/sc - (2*A*mx + B*my)/sc**2,
+                    E/sc - (2*C*my + B*mx)/sc**2,
+                    F - (D*mx + E*my)/sc + (A*mx**2 + B*mx*my + C*my**2)/sc**2])
+
+    # Unit length with A > 0, so that get_ellipse_params returns a >= b
+    return fit / (np.sign(fit[0]) * np.linalg.norm(fit))
 
 def fit_ellipse_svd(x, y):
     """
@@ -152,16 +311,48 @@ def fit_ellipse_svd(x, y):
     Note: The function assumes that the input points are in 2D and the number of points is greater than or equal to 6.
     """
 
-    x = np.array(x)
-    y = np.array(y)
-    x = x[:, np.newaxis]
-    y = y[:, np.newaxis]
-
-    D = np.hstack((x * x, x * y, y * y, x, y, np.ones_like(x)))
-    U, S, Vt = np.linalg.svd(D)
+    D = _design(x, y)
+    U, S, Vt = np.linalg.svd(D, full_matrices=False)
 
     return Vt[-1]
 
+def fit_ellipse_stable(x, y):
+    """
+    Fits an ellipse to a set of 2D points using the numerically stable direct least squares method of Halir and Flusser.
+
+    The 6x6 generalized eigenvalue problem of the direct fit is split into a quadratic and a linear part,
+    which reduces it to a 3x3 eigenvalue problem without inverting the (often ill-conditioned) scatter matrix.
+
+    Parameters:
+        x (array-like): The x-coordinates of the points.
+        y (array-like): The y-coordinates of the points.
+
+    Returns:
+        array-like: The coefficients of the fitted ellipse, normalised to unit length with A > 0.
+    """
+
+    # Scatter matrix blocks for the quadratic and linear parts of the design matrix
+    S = _scatter(x, y)
+    S1 = S[:3, :3]
+    S2 = S[:3, 3:]
+    S3 = S[3:, 3:]
+
+    # Linear coefficients as a function of the quadratic ones
+    T = -np.linalg.solve(S3, S2.T)
+    M = S1 + S2 @ T
+
+    # Premultiply with the inverse of the 3x3 constraint matrix
+    M = np.vstack((M[2] / 2, -M[1], M[0] / 2))
+
+    E, V = np.linalg.eig(M)
+    V = np.real(V)
+    cond = 4 * V[0] * V[2] - V[1]**2
+    a1 = V[:, np.argmax(cond)]
+    fit = np.concatenate((a1, T @ a1))
+
+    # Unit length with A > 0, so that get_ellipse_params returns a >= b
+    return fit / (np.sign(fit[0]) * np.linalg.norm(fit))
+
 def gen_circle(center, r, axis, npoints=100):
     """
     Generate points on a circle in 3D space.
@@ -179,24 +370,23 @@ def gen_circle(center, r, axis, npoints=100):
         The first point is the circle center point
     """
 
-    t = np.linspace(0,1,npoints)
+    theta = np.linspace(0, 2*np.pi, npoints)
+    c = r*np.cos(theta)
+    s = r*np.sin(theta)
 
-    if axis == 'x':
-        x = np.ones_like(t) * center[0]
-        y = r*np.cos(t*2*np.pi) + center[1]
-        z = r*np.sin(t*2*np.pi) + center[2]
+    # Column layout (cos, sin) for the two in-plane axes
+    planes = {'x': (1, 2), 'y': (0, 2), 'z': (1, 0)}
+    try:
+        i_cos, i_sin = planes[axis]
+    except KeyError:
+        raise ValueError(f"axis must be 'x', 'y' or 'z', not {axis}")
 
-    elif axis == 'y':
-        x = r*np.cos(t*2*np.pi) + center[0]
-        y = np.ones_like(t) * center[1]
-        z = r*np.sin(t*2*np.pi) + center[2]
+    pts = np.empty((npoints+1, 3))
+    pts[:] = center
+    pts[1:, i_cos] += c
+    pts[1:, i_sin] += s
 
-    elif axis == 'z':
-        x = r*np.sin(t*2*np.pi) + center[0]
-        y = r*np.cos(t*2*np.pi) + center[1]
-        z = np.ones_like(t) * center[2]
-
-    points_df = pd.DataFrame.from_dict({'x':[center[0], *x], 'y':[center[1], *y], 'z':[center[2], *z]})
+    points_df = pd.DataFrame(pts, columns=['x', 'y', 'z'])
 
     return points_df
 
@@ -215,16 +405,12 @@ def transform_points(points_df, inv_transformlist):
     
     points_xfm = ants.apply_transforms_to_points(3, points_df, transformlist=inv_transformlist)
 
-    x0 = points_df['x'][1:] - points_df['x'][0]
-    y0 = points_df['y'][1:] - points_df['y'][0]
-    z0 = points_df['z'][1:] - points_df['z'][0]
-
-    x1 = points_xfm['x'][1:] - points_xfm['x'][0]
-    y1 = points_xfm['y'][1:] - points_xfm['y'][0]
-    z1 = points_xfm['z'][1:] - points_xfm['z'][0]
+    # Points relative to the first (center) point, as (3, N) arrays
+    a0 = points_df[['x', 'y', 'z']].to_numpy(dtype=float)
+    a1 = points_xfm[['x', 'y', 'z']].to_numpy(dtype=float)
 
-    p0 = np.stack((x0,y0,z0))
-    p1 = np.stack((x1,y1,z1))
+    p0 = np.ascontiguousarray((a0[1:] - a0[0]).T)
+    p1 = np.ascontiguousarray((a1[1:] - a1[0]).T)
 
     return p0, p1
 
@@ -235,7 +421,7 @@ def get_ellipse_params(x, y, method='svd'):
     Parameters:
         x (array-like): The x-coordinates of the data points.
         y (array-like): The y-coordinates of the data points.
-        method (str): Fit method. svd or eig. Default: svd
+        method (str): Fit method. svd, eig or stable. Default: svd
 
     Returns:
         dict: A dictionary containing the ellipse parameters:
@@ -250,6 +436,8 @@ def get_ellipse_params(x, y, method='svd'):
 
     if method == 'svd':
         fit = fit_ellipse_svd(x, y)
+    elif method == 'stable':
+        fit = fit_ellipse_stable(x, y)
     else:
         fit = fit_ellipse_eig(x,y)
     A,B,C,D,E,F = fit
@@ -280,11 +468,61 @@ def get_ellipse(a, b, theta, x0, y0, n=100, **kwargs):
     """
     
     t = np.linspace(0,1,n)*np.pi*2
-    x_el = a * np.cos(t) * np.cos(theta) - b*np.sin(theta)*np.sin(t) + x0
-    y_el = a * np.sin(theta) * np.cos(t) + b*np.cos(theta)*np.sin(t) + y0
+    ct = np.cos(t)
+    st = np.sin(t)
+    cT = np.cos(theta)
+    sT = np.sin(theta)
+
+    # x = a*cos(theta)*cos(t) - b*sin(theta)*sin(t) + x0, scalar factors folded first
+    x_el = np.multiply(ct, a*cT)
+    x_el -= np.multiply(st, b*sT, out=t)
+    x_el += x0
+
+    # y = a*sin(theta)*cos(t) + b*cos(theta)*sin(t) + y0, reusing the cos/sin buffers
+    y_el = np.multiply(ct, a*sT, out=ct)
+    y_el += np.multiply(st, b*cT, out=st)
+    y_el += y0
 
     return x_el, y_el
 
+class ROI():
+    """
+    Flat voxel indices of a region of interest, for repeated metric calculations on the same mask.
+
+    Parameters:
+    mask (ndarray or ants image): The mask indicating the region of interest (voxels equal to 1).
+    """
+
+    def __init__(self, mask):
+        mask = _as_array(mask)
+        self.shape = mask.shape
+        self.idx = np.flatnonzero(mask.ravel() == 1)
+        self.n = self.idx.size
+
+    def values(self, img):
+        """
+        Get the image values inside the region of interest.
+
+        Parameters:
+        img (ndarray or ants image): The image, same shape as the mask.
+
+        Returns:
+        ndarray: The image values inside the region of interest.
+
+        Raises:
+        ValueError: If the image shape does not match the mask shape.
+        """
+        img = _as_array(img)
+        if img.shape != self.shape:
+            raise ValueError(f'Image shape {img.shape} does not match mask shape {self.shape}')
+        return img.ravel()[self.idx]
+
+def _as_array(img):
+    return img.numpy() if hasattr(img, 'numpy') else np.asarray(img)
+
+def _as_roi(mask):
+    return mask if isinstance(mask, ROI) else ROI(mask)
+
 def calc_psnr(img1, img2, mask):
     """
     Calculate the Peak Signal-to-Noise Ratio (PSNR) between two images.
@@ -292,17 +530,19 @@ def calc_psnr(img1, img2, mask):
     Parameters:
     img1 (ndarray or ants image): The first image.
     img2 (ndarray or ants image): The second image.
-    mask (ndarray or ants image): The mask indicating the region of interest.
+    mask (ndarray, ants image or ROI): The mask indicating the region of interest.
 
     Returns:
     float: The PSNR value.
 
     """
-    I1 = img1[mask==1]
-    I2 = img2[mask==1]
-    MSE = np.sum((I1-I2)**2)/len(I1)
-    R = np.mean([max(I1),max(I2)])
-    PSNR = 10*np.log10(R**2/MSE)
+    roi = _as_roi(mask)
+    I1 = roi.values(img1).astype(np.float32, copy=False)
+    I2 = roi.values(img2).astype(np.float32, copy=False)
+    d = I1 - I2
+    MSE = float(d @ d)/d.size
+    R = 0.5*(float(I1.max()) + float(I2.max()))
+    PSNR = 10*np.log10(R*R/MSE)
     return MSE, PSNR
 
 def calc_ssim(img1, img2, mask, kw=11, sigma=0):
@@ -317,10 +557,12 @@ def calc_ssim(img1, img2, mask, kw=11, sigma=0):
         multichannel=False, gaussian_weights=gauss_window, full=True, use_sample_covariance=use_sample_covariance,
         sigma=sigma)
     
-    return S[mask==1].mean()
+    return _as_roi(mask).values(S).mean()
 
 def calc_snr_diff(img1, img2, mask):
-    img_diff = img1-img2
-    img_mean = (img1+img2)/2
-    return img_mean[mask==1].mean()/img_diff[mask==1].std()/np.sqrt(2)
+    roi = _as_roi(mask)
+    I1 = roi.values(img1).astype(np.float32, copy=False)
+    I2 = roi.values(img2).astype(np.float32, copy=False)
+    img_mean = (I1 + I2).mean()/2
+    return img_mean/(I1 - I2).std()/np.sqrt(2)
 